@@ -4,93 +4,179 @@ Utility functions for EstiBuild Streamlit app.
 Provides:
 - parse_dxf_to_polygons(dxf_path) -> list of shapely Polygons
 - compute_areas_and_walls(polygons, wall_thickness, units) -> results dict
+- iter_rooms(results) -> per-room dicts
 - estimate_materials_for_workitems(results, ...) -> materials dict
 - render_plan_image_bytes(polygons) -> PNG bytes
 - export_measurement_sheets_bytes(results, materials) -> XLSX bytes
 """
 
 import ezdxf
-from shapely.geometry import Polygon, LineString
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
 from shapely.ops import unary_union, polygonize
+import functools
 import math
-import matplotlib.pyplot as plt
+import os
+from PIL import Image, ImageDraw
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import pandas as pd
+
+try:
+    import xlsxwriter
+except ImportError:  # fall back to openpyxl's write-only mode
+    xlsxwriter = None
+
+# 1:2:4 nominal concrete mix: dry volume factor, part fractions by volume
+# and bulk density of cement (kg/m3)
+_MIX_124_FACTOR = 1.54
+_CEMENT_FRAC = 1 / 7
+_SAND_FRAC = 2 / 7
+_AGG_FRAC = 4 / 7
+_CEMENT_DENSITY = 1440
+
+_PAINT_COVERAGE_M2_PER_L = 10
+
+# Shapely releases the GIL inside GEOS, so large geometry arrays can be
+# split across threads. A chunk of this many rooms takes several ms to
+# buffer, which keeps pool dispatch negligible; typical plans stay inline.
+_THREAD_MIN_CHUNK = 1000
+_THREAD_WORKERS = os.cpu_count() or 4
+
+@functools.lru_cache(maxsize=1)
+def _thread_pool():
+    # created on first use, so importing the module starts no threads
+    return ThreadPoolExecutor(max_workers=_THREAD_WORKERS)
+
+def _threaded(func, geoms, *args, **kwargs):
+    """
+    Apply a vectorized shapely function to chunks of geoms on the thread
+    pool and concatenate the results. Small inputs run on the caller's thread.
+    """
+    n_chunks = min(_THREAD_WORKERS, len(geoms) // _THREAD_MIN_CHUNK)
+    if n_chunks < 2:
+        return func(geoms, *args, **kwargs)
+    chunks = np.array_split(geoms, n_chunks)
+    return np.concatenate(list(_thread_pool().map(lambda chunk: func(chunk, *args, **kwargs), chunks)))
+
+def _derive_walls(areas, perims, bounds, wall_thickness):
+    carpet = np.maximum(0.0, areas - perims * wall_thickness)
+    long_walls = 2 * (bounds[:, 2] - bounds[:, 0])
+    short_walls = 2 * (bounds[:, 3] - bounds[:, 1])
+    return carpet, long_walls, short_walls
 
 def parse_dxf_to_polygons(dxf_path):
     """
     Parse a DXF file and attempt to polygonize closed polylines / loops.
     Returns a list of shapely Polygons (in CAD units).
+
+    Results are cached on (path, mtime, size), so Streamlit reruns on an
+    unchanged file skip the parse entirely.
     """
+    path = os.path.abspath(dxf_path)
+    st = os.stat(path)
+    return list(_parse_dxf_cached(path, st.st_mtime_ns, st.st_size))
+
+@functools.lru_cache(maxsize=32)
+def _parse_dxf_cached(dxf_path, mtime_ns, size):
     doc = ezdxf.readfile(dxf_path)
     msp = doc.modelspace()
 
-    geom_lines = []
-    for e in msp:
+    # One (n, 2) xy array per line, concatenated afterwards so every
+    # LineString can be built in a single shapely call.
+    parts = []
+    # Rounded, direction-normalized vertex keys of lines already added, so
+    # duplicated entities (overlapping layers, repeated blocks) reach GEOS once.
+    seen = set()
+    for e in msp.query("LINE LWPOLYLINE POLYLINE"):
         t = e.dxftype()
         if t == "LINE":
             start = e.dxf.start
             end = e.dxf.end
-            geom_lines.append(LineString([start, end]))
-        elif t in ("LWPOLYLINE", "POLYLINE"):
-            # ezdxf LWPOLYLINE: use get_points()
+            pts = np.array([[start.x, start.y], [end.x, end.y]])
+        else:
             try:
-                pts = [tuple(p[:2]) if len(p) >= 2 else tuple(p) for p in e.get_points()]
+                if t == "LWPOLYLINE":
+                    # only request xy, skipping the width/bulge fields
+                    pts = np.asarray(e.get_points("xy"), dtype=np.float64)
+                else:
+                    # POLYLINE entity stores its points as vertices
+                    pts = np.asarray([v.dxf.location for v in e.vertices], dtype=np.float64)[:, :2]
             except Exception:
-                # fallback for POLYLINE entity that uses vertices
-                try:
-                    pts = [tuple(v.dxf.location) for v in e.vertices]
-                except Exception:
-                    pts = []
-            if len(pts) >= 3:
-                if pts[0] != pts[-1]:
-                    pts.append(pts[0])
-                geom_lines.append(LineString(pts))
-
-    if not geom_lines:
-        return []
-
+                continue
+            if len(pts) < 3:
+                continue
+            if not np.array_equal(pts[0], pts[-1]):
+                pts = np.vstack([pts, pts[:1]])
+
+        # + 0.0 folds -0.0 into 0.0 so both produce the same bytes
+        rounded = np.round(pts, 6) + 0.0
+        key = min(rounded.tobytes(), rounded[::-1].tobytes())
+        if key in seen:
+            continue
+        seen.add(key)
+        parts.append(pts)
+
+    if not parts:
+        return ()
+
+    geom_lines = shapely.linestrings(
+        np.concatenate(parts),
+        indices=np.repeat(np.arange(len(parts)), [len(pts) for pts in parts]),
+    )
     merged = unary_union(geom_lines)
-    polys = list(polygonize(merged))
-    polys = [poly for poly in polys if poly.area > 1e-6]
-    return polys
+    polys = np.asarray(list(polygonize(merged)), dtype=object)
+    return tuple(polys[shapely.area(polys) > 1e-6].tolist())
 
 def compute_areas_and_walls(polygons, wall_thickness=0.2, units="meters"):
     """
     Compute per-polygon area, carpet area (inward offset), perimeter, and
     approximate long/short wall lengths using bounding box method.
+
+    Results are memoized on the polygons and parameters. Each call gets its
+    own dicts and notes list; the room columns are shared read-only arrays.
     """
-    rooms = []
-    total_built_up = 0.0
-    total_carpet = 0.0
-    total_perimeter = 0.0
-
-    for idx, poly in enumerate(polygons, start=1):
-        area = poly.area
-        perim = poly.length
-        try:
-            inner = poly.buffer(-wall_thickness)
-            carpet_area = inner.area if not inner.is_empty else max(0.0, area - perim * wall_thickness)
-        except Exception:
-            carpet_area = max(0.0, area - perim * wall_thickness)
-
-        minx, miny, maxx, maxy = poly.bounds
-        long_wall = 2 * (maxx - minx)
-        short_wall = 2 * (maxy - miny)
-
-        rooms.append({
-            "id": idx,
-            "area": area,
-            "carpet_area": carpet_area,
-            "perimeter": perim,
-            "long_wall_length": long_wall,
-            "short_wall_length": short_wall,
-            "bounds": poly.bounds,
-        })
-
-        total_built_up += area
-        total_carpet += carpet_area
-        total_perimeter += perim
+    cached = _compute_areas_cached(tuple(polygons), wall_thickness, units)
+    return {
+        **cached,
+        "rooms": dict(cached["rooms"]),
+        "totals": dict(cached["totals"]),
+        "notes": list(cached["notes"]),
+    }
+
+@functools.lru_cache(maxsize=32)
+def _compute_areas_cached(polygons, wall_thickness, units):
+    geoms = np.asarray(polygons, dtype=object)
+    areas = shapely.area(geoms)
+    perims = shapely.length(geoms)
+    bounds = shapely.bounds(geoms).reshape(-1, 4)
+
+    strip_carpet, long_walls, short_walls = _derive_walls(areas, perims, bounds, wall_thickness)
+
+    # Carpet area from an inward offset; fall back to the perimeter strip
+    # deduction where the offset collapses the room entirely. Only the area
+    # is used, so a coarser arc approximation at reflex corners suffices.
+    inner = _threaded(shapely.buffer, geoms, -wall_thickness, quad_segs=4)
+    carpet = np.where(shapely.is_empty(inner), strip_carpet, shapely.area(inner))
+
+    # Per-room values are kept as 1-D columns (one ndarray per field) so
+    # they load straight into a DataFrame; use iter_rooms() for a per-room
+    # dict view.
+    rooms = {
+        "id": np.arange(1, len(geoms) + 1),
+        "area": areas,
+        "carpet_area": carpet,
+        "perimeter": perims,
+        "long_wall_length": long_walls,
+        "short_wall_length": short_walls,
+        "minx": bounds[:, 0],
+        "miny": bounds[:, 1],
+        "maxx": bounds[:, 2],
+        "maxy": bounds[:, 3],
+    }
+    # Columns are shared by every cache hit, so lock them against writes
+    for column in rooms.values():
+        column.setflags(write=False)
 
     recommended_setback = 1.5
     margin_note = f"Recommended minimum setback/margin around building: {recommended_setback} m (adjust per local rules)."
@@ -100,13 +186,24 @@ def compute_areas_and_walls(polygons, wall_thickness=0.2, units="meters"):
         "wall_thickness": wall_thickness,
         "rooms": rooms,
         "totals": {
-            "built_up_area": total_built_up,
-            "carpet_area": total_carpet,
-            "perimeter": total_perimeter,
+            "built_up_area": float(areas.sum()),
+            "carpet_area": float(carpet.sum()),
+            "perimeter": float(perims.sum()),
         },
-        "notes": [margin_note],
+        "notes": (margin_note,),
     }
 
+def iter_rooms(results):
+    """
+    Yield one dict per room from the column layout in results["rooms"].
+    """
+    rooms = results["rooms"]
+    keys = list(rooms)
+    for values in zip(*(rooms[key].tolist() for key in keys)):
+        room = dict(zip(keys, values))
+        room["bounds"] = tuple(room.pop(key) for key in ("minx", "miny", "maxx", "maxy"))
+        yield room
+
 def estimate_materials_for_workitems(results, cement_bag_kg=50, plaster_thickness_mm=12, tile_size_mm=600):
     """
     Estimate quantities for a simplified set of 12 work items from
@@ -149,31 +246,20 @@ def estimate_materials_for_workitems(results, cement_bag_kg=50, plaster_thicknes
     tile_area_m2 = (tile_size_mm / 1000.0) ** 2
     tiles_required = math.ceil(carpet / tile_area_m2) if tile_area_m2 > 0 else 0
 
-    # Concrete mix estimate (1:2:4), dry volume factor 1.54
-    def concrete_materials_for_volume(vol_m3, mix=(1,2,4)):
-        factor = 1.54
-        dry_volume = vol_m3 * factor
-        total_parts = sum(mix)
-        cement_part = mix[0]
-        cement_volume = dry_volume * (cement_part / total_parts)
-        cement_kg = cement_volume * 1440
-        cement_bags = cement_kg / cement_bag_kg
-        sand_volume = dry_volume * (mix[1] / total_parts)
-        agg_volume = dry_volume * (mix[2] / total_parts)
-        return {
-            "concrete_volume_m3": vol_m3,
-            "cement_kg": cement_kg,
-            "cement_bags": cement_bags,
-            "sand_m3": sand_volume,
-            "aggregate_m3": agg_volume,
-        }
-
+    # Concrete mix estimate (1:2:4)
     total_concrete_volume = slab_volume + footing_volume + pcc_volume
-    concrete_mat = concrete_materials_for_volume(total_concrete_volume, mix=(1,2,4))
+    dry_volume = total_concrete_volume * _MIX_124_FACTOR
+    cement_kg = dry_volume * _CEMENT_FRAC * _CEMENT_DENSITY
+    concrete_mat = {
+        "concrete_volume_m3": total_concrete_volume,
+        "cement_kg": cement_kg,
+        "cement_bags": cement_kg / cement_bag_kg,
+        "sand_m3": dry_volume * _SAND_FRAC,
+        "aggregate_m3": dry_volume * _AGG_FRAC,
+    }
 
     # Paint: 1 coat coverage ~10 m2 per litre
-    paint_coverage_m2_per_l = 10
-    paint_liters = wall_area / paint_coverage_m2_per_l
+    paint_liters = wall_area / _PAINT_COVERAGE_M2_PER_L
 
     # Reinforcement steel estimate (kg)
     steel_per_m3 = 80
@@ -207,21 +293,43 @@ def estimate_materials_for_workitems(results, cement_bag_kg=50, plaster_thicknes
         "contingency_note": contingency_note,
     }
 
-def render_plan_image_bytes(polygons):
+def render_plan_image_bytes(polygons, size=600, pad=10):
     """
     Render the polygons to a PNG image and return bytes.
+
+    The PNG is memoized on the polygons, so reruns with an unchanged plan
+    skip rasterization.
     """
-    plt.figure(figsize=(6,6))
-    for poly in polygons:
-        x, y = poly.exterior.xy
-        plt.plot(x, y, color="black")
-        plt.fill(x, y, alpha=0.1)
-    plt.gca().set_aspect("equal", adjustable="box")
-    plt.axis("off")
+    return _render_plan_cached(tuple(polygons), size, pad)
+
+@functools.lru_cache(maxsize=8)
+def _render_plan_cached(polygons, size, pad):
+    # RGB canvas so the translucent RGBA fill blends onto the background
+    img = Image.new("RGB", (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(img, "RGBA")
+
+    geoms = np.asarray(polygons, dtype=object)
+    if len(geoms):
+        coords, idx = shapely.get_coordinates(shapely.get_exterior_ring(geoms), return_index=True)
+        minx, miny = coords.min(axis=0)
+        maxx, maxy = coords.max(axis=0)
+        # Uniform scale keeps the plan at equal aspect and centred; y is
+        # flipped so north stays up in image space.
+        extent = np.array([maxx - minx, maxy - miny])
+        scale = (size - 2 * pad) / max(extent.max(), 1e-12)
+        margin = (size - extent * scale) / 2
+        offset = np.array([minx, maxy])
+        pixels = ((coords - offset) * (scale, -scale) + margin).astype(np.int32)
+        # One flat x, y, x, y, ... list for every ring; each polygon draw is
+        # then a list slice rather than a per-vertex tuple rebuild.
+        flat = pixels.ravel().tolist()
+        starts = np.searchsorted(idx, np.arange(len(geoms) + 1)) * 2
+        for start, end in zip(starts[:-1].tolist(), starts[1:].tolist()):
+            if end - start >= 4:
+                draw.polygon(flat[start:end], outline=(0, 0, 0, 255), fill=(0, 0, 0, 25))
+
     buf = BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="png", dpi=150, bbox_inches="tight", pad_inches=0.01)
-    plt.close()
+    img.save(buf, format="PNG", compress_level=1)
     buf.seek(0)
     return buf.read()
 
@@ -231,33 +339,56 @@ def export_measurement_sheets_bytes(results, materials):
     Return bytes of the xlsx file.
     """
     rooms = results["rooms"]
-    room_rows = []
-    for r in rooms:
-        room_rows.append({
-            "room_id": r["id"],
-            "area_m2": r["area"],
-            "carpet_area_m2": r["carpet_area"],
-            "perimeter_m": r["perimeter"],
-            "long_wall_m": r["long_wall_length"],
-            "short_wall_m": r["short_wall_length"]
-        })
-    df_rooms = pd.DataFrame(room_rows)
+    room_rows = zip(*(
+        rooms[key].tolist()
+        for key in ("id", "area", "carpet_area", "perimeter", "long_wall_length", "short_wall_length")
+    ))
 
     totals = results["totals"]
     abstract_rows = [
-        {"description": "Built-up Area (m2)", "quantity": totals["built_up_area"]},
-        {"description": "Carpet Area (m2)", "quantity": totals["carpet_area"]},
-        {"description": "Perimeter (m)", "quantity": totals["perimeter"]},
+        ("Built-up Area (m2)", totals["built_up_area"]),
+        ("Carpet Area (m2)", totals["carpet_area"]),
+        ("Perimeter (m)", totals["perimeter"]),
     ]
     if materials:
         for w in materials["workitems"]:
             q = w.get("quantity") if "quantity" in w else w.get("quantity_m3", "")
-            abstract_rows.append({"description": w["item"], "quantity": q})
-    df_abstract = pd.DataFrame(abstract_rows)
+            abstract_rows.append((w["item"], q))
+
+    sheets = [
+        ("measurement_sheet",
+         ("room_id", "area_m2", "carpet_area_m2", "perimeter_m", "long_wall_m", "short_wall_m"),
+         room_rows),
+        ("abstract_sheet", ("description", "quantity"), abstract_rows),
+    ]
 
     out = BytesIO()
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
-        df_rooms.to_excel(writer, sheet_name="measurement_sheet", index=False)
-        df_abstract.to_excel(writer, sheet_name="abstract_sheet", index=False)
+    if xlsxwriter is not None:
+        _write_sheets_xlsxwriter(out, sheets)
+    else:
+        _write_sheets_openpyxl(out, sheets)
     out.seek(0)
     return out.read()
+
+def _write_sheets_xlsxwriter(out, sheets):
+    # constant_memory flushes each row as it is written, which is safe
+    # because every sheet is written top to bottom exactly once.
+    wb = xlsxwriter.Workbook(out, {"constant_memory": True})
+    for name, header, rows in sheets:
+        ws = wb.add_worksheet(name)
+        ws.write_row(0, 0, header)
+        for i, row in enumerate(rows, start=1):
+            ws.write_row(i, 0, row)
+    wb.close()
+
+def _write_sheets_openpyxl(out, sheets):
+    # imported here so openpyxl is only needed when xlsxwriter is missing
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    for name, header, rows in sheets:
+        ws = wb.create_sheet(name)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+    wb.save(out)